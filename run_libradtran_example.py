@@ -95,12 +95,15 @@ parser_options_dict = {"output_format": 0,
 print("\nRemember to specify libradtran binary location!!!")
 libradtran_bin_file_loc = "libRadtran-2.0.5/bin"
 
-# Calling the run_libradtran producess the results in format list(configparser object; wavelength)
+# Calling the run_libradtran producess the results in format dict(result name; numpy array over wavelength)
 results_example_1 = libis.run_libradtran(libradtran_bin_file_loc, input_str, parser_options_dict)
 
 print("\nResults are presented in a dict format. User can then create their own code to pick the relevatn information. Result Dict:")
 print(results_example_1)
 
+# If one dict per wavelength is needed, results can be converted to a list of dicts
+print(libis.results_as_dicts(results_example_1))
+
 
 # In[]:
 # ########################################################################
@@ -45,7 +45,8 @@ SOFTWARE.
 This script provides two main ways to run libradtran and some other helper functions to work with it for example pmom.
 
 Two main functions to run libradtran are run_libradtran and run_conf_files_libradtran.
-For other functions there are run_pmom, profile_parser and array_to_string_parser.
+For asyncio users there is run_libradtran_async.
+For other functions there are run_pmom, compile_runner, parse_uvspec_output, results_as_dicts, profile_parser and array_to_string_parser.
 
 ################## Design and use philosophy ##################
 The main design philosophy of this code is to provide a lightweight python interface with libradtran that can support full use 
@@ -56,7 +57,8 @@ provided in the form of a output_format in either a init file or configure parse
 ################## Functions ##################
 
 ##### run_libradtran #####
-run_libradtran script takes tree variables as libradtran_bin_file_loc, params and conf.
+run_libradtran script takes tree variables as libradtran_bin_file_loc, params and conf
+and optionally out_dtype.
 
 params is a string representing the standard libradtran outputfile.
 
@@ -72,15 +74,57 @@ output_format = 1 corresponds to string shape were umu is specified but phi is n
 output_format = 2 corresponds to string shape were umu and phi are specified. 
 
 libradtran_bin_file_loc is the location of users libradtran binary.
+uvspec is started directly without a shell, ~ and environment variables like $HOME in the
+location are expanded by the script.
+
+Results are given as one dict of numpy arrays where the first axis is the wavelength:
+lambda, edir, edn, eup, uavgdir, uavgdn and uavup have shape (wavelength,),
+umu and u0u(umu) have shape (wavelength, umu), phi has shape (wavelength, phi) and
+uu(umu,phi) has shape (wavelength, phi, umu). umu, phi, u0u(umu) and uu(umu,phi) are None
+if the output_format does not contain them. error/verbose message is the uvspec stderr string.
+If uvspec fails the stderr string is returned instead of the dict.
+
+out_dtype is the numpy dtype of the result arrays, by default np.float32.
+uvspec prints its results with about 6 significant digits so float32 keeps all of the
+printed precision while using half of the memory. Use np.float64 if the results are used
+in calculations that need more precision.
+
+
+##### results_as_dicts #####
+Converts the results of run_libradtran to the older format: a list with one dict per wavelength.
+
+
+##### run_libradtran_async #####
+Coroutine version of run_libradtran that takes the same variables and gives the same results.
+Many runs can be awaited together for example with asyncio.gather, so that several uvspec
+processes are running at the same time inside one event loop.
+
+
+##### parse_uvspec_output #####
+Parses the raw uvspec stdout and stderr (bytes) and return code to the results given by run_libradtran.
+conf is the same parser configuration as in run_libradtran.
+
+
+##### compile_runner #####
+compile_runner takes conf and optionally out_dtype as in run_libradtran and gives an output parser
+function that takes the raw uvspec stdout, stderr and return code, like parse_uvspec_output.
+The parser has the output_format and umu_length fixed, and parsers are cached so the same
+parser options give the same parser. When many runs use the same conf the parser can be made
+once and given to run_libradtran or run_libradtran_async with the output_parser variable.
 
 
 ##### run_conf_files_libradtran #####
-run_conf_files_libradtran takes in tree variables: libradtran_bin_file_loc, conf_file_list, verbose=True
+run_conf_files_libradtran takes in five variables: libradtran_bin_file_loc, conf_file_list, verbose=True, max_workers=None, out_dtype=np.float32
 
 libradtran_bin_file_loc is the location of libradtran binary.
 
 conf_file_list is a list of either configparser objects or a list of locations of configparser .ini files.
 
+max_workers is the number of uvspec runs executed at the same time. By default it is the number of cpus.
+Results are returned in the same order as conf_file_list.
+
+out_dtype is the numpy dtype of the result arrays as in run_libradtran.
+
 configparser object and .ini files needs to be setup in following way:
 
 There needs to be a parser_options and main_str key.
@@ -100,6 +144,11 @@ main_str key will contain the main input file for libradtran.
 
 External files can also be added to main program by usesing key: temp_strs and so that
 it contains the name of the variable in libradtran input file and then the file contents in string.
+The external files are written to one temporary directory that is removed after all runs are done.
+External files with identical contents are written only once and shared by all configurations.
+
+Parsed .ini files are cached, so the same .ini file given many times is read only once.
+If the file is modified it is read again.
 
 
 ##### run_pmom #####
@@ -143,21 +192,32 @@ To avoid this problem, you can run two separate runs with single zout option.
 # Pakages
 # ########################################################################
 
+import asyncio
+import hashlib
+import os
 import tempfile
+import threading
 
 import numpy as np
 import subprocess as sp
 
-from io import StringIO
+from io import BytesIO, StringIO
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 # In[]:
 # ########################################################################
 # run_libRadtran Related Functions
 # ########################################################################
 
-def output_format_1_parser(vals):
-    outdata_basic = np.genfromtxt(StringIO(vals))
+def parse_numeric_rows(rows, dtype=np.float32):
+    # rows are lines of uvspec stdout as bytes, parsed in one loadtxt call
+    return np.loadtxt(BytesIO(b"\n".join(rows)), ndmin=2, dtype=dtype)
+
+
+def output_format_1_parser(vals, umu_length=0, dtype=np.float32):
+    outdata_basic = parse_numeric_rows(vals, dtype)
     umu = None
     phi = None
     u0u = None
@@ -165,140 +225,224 @@ def output_format_1_parser(vals):
     return outdata_basic, umu, phi, u0u, uu
 
 
-def output_format_2_parser(vals):
-    outdata_basic = np.genfromtxt(StringIO(vals[0]))
-    for i, val in enumerate(vals[1:]):
-        if not val:
-            continue
-        row = np.expand_dims(np.genfromtxt(StringIO(val)), axis=0)
-        if i == 0:
-            umu = row[0, 0]
-            u0u = row[0, 1]
-        else:
-            umu = np.append(umu, row[0, 0])
-            u0u = np.append(u0u, row[0, 1])
+def output_format_2_parser(vals, umu_length, dtype=np.float32):
+    stride = 1 + umu_length
+    outdata_basic = parse_numeric_rows(vals[0::stride], dtype)
+    umu_rows = [val for ind, val in enumerate(vals) if ind % stride]
+    rows = parse_numeric_rows(umu_rows, dtype).reshape(len(outdata_basic), umu_length, -1)
+    umu = rows[:, :, 0]
+    u0u = rows[:, :, 1]
     uu = None
     phi = None
     return outdata_basic, umu, phi, u0u, uu
 
 
-def output_format_3_parser(vals):
-    outdata_basic = np.genfromtxt(StringIO(vals[0]))
-    phi  = np.genfromtxt(StringIO(vals[1]))
-    for i, val in enumerate(vals[2:]):
-        if not val:
-            continue
-        row = np.expand_dims(np.genfromtxt(StringIO(val)), axis=0)
-        if i == 0:
-            umu = row[0, 0]
-            u0u = row[0, 1]
-            uu = np.expand_dims(row[0, 2:], axis=1)
-        else:
-            umu = np.append(umu, row[0, 0])
-            u0u = np.append(u0u, row[0, 1])
-            uu = np.append(uu, np.expand_dims(row[0, 2:], axis=1), axis=1)
+def output_format_3_parser(vals, umu_length, dtype=np.float32):
+    stride = 2 + umu_length
+    outdata_basic = parse_numeric_rows(vals[0::stride], dtype)
+    phi = parse_numeric_rows(vals[1::stride], dtype)
+    umu_rows = [val for ind, val in enumerate(vals) if ind % stride >= 2]
+    rows = parse_numeric_rows(umu_rows, dtype).reshape(len(outdata_basic), umu_length, -1)
+    umu = rows[:, :, 0]
+    u0u = rows[:, :, 1]
+    uu = rows[:, :, 2:].transpose(0, 2, 1)
     return outdata_basic, umu, phi, u0u, uu
 
 
+# output_format: (parser, header rows per wavelength, has umu_length umu rows per wavelength)
+OUTPUT_FORMAT_PARSERS = {
+    0: (output_format_1_parser, 1, False),
+    1: (output_format_2_parser, 1, True),
+    2: (output_format_3_parser, 2, True),
+    }
+
+
 # In[]:
 # ########################################################################
 # Main run_libRadtran Function
 # ########################################################################
 
-def run_libradtran(libradtran_bin_file_loc, params, conf):
-    pros = sp.Popen(f"{libradtran_bin_file_loc}/uvspec", shell=True, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    vals, error = pros.communicate(input=str.encode(params))
-    vals = vals.decode()
-    error = error.decode()
-    if pros.returncode != 0:
-        return error
-        #raise OSError(error)
-    else:
-        output = list()
-        vals = vals.split("\n")        
-        if int(conf["output_format"]) == 0:
-            loop_row_count = float(len(vals) - 1)
-        elif int(conf["output_format"]) == 1:
-            loop_row_count = (len(vals) - 1)/(1 + int(conf["umu_length"]))
-        elif int(conf["output_format"]) == 2:
-            loop_row_count = (len(vals) - 1)/(2 + int(conf["umu_length"]))
+@lru_cache(maxsize=None)
+def _compile_output_parser(output_format, umu_length, out_dtype):
+    parser, header_row_count, _ = OUTPUT_FORMAT_PARSERS[output_format]
+    stride = header_row_count + umu_length
+
+    def parse_output(vals, error, returncode):
+        # stdout is parsed as bytes, only the short stderr message is decoded
+        error = error.decode()
+        if returncode != 0:
+            return error
+            #raise OSError(error)
+        vals = vals.split(b"\n")        
+        loop_row_count = (len(vals) - 1)/stride
         if not loop_row_count.is_integer():
             print("Something went wrong with row counting")
             print(loop_row_count)
-        for ind in range(int(loop_row_count)):
-            if int(conf["output_format"]) == 0:
-                rows = vals[ind]
-                outdata_basic, umu, phi, u0u, uu = output_format_1_parser(rows)
-            elif int(conf["output_format"]) == 1:
-                rows = vals[int(ind*(1 + int(conf["umu_length"]))): int((ind+1)*(1 + int(conf["umu_length"])))]                
-                outdata_basic, umu, phi, u0u, uu = output_format_2_parser(rows)
-            elif int(conf["output_format"]) == 2:
-                rows = vals[int(ind*(2 + int(conf["umu_length"]))): int((ind+1)*(2 + int(conf["umu_length"])))]
-                outdata_basic, umu, phi, u0u, uu = output_format_3_parser(rows)
-            output_dict = {
-                "lambda": outdata_basic[0], 
-                "edir": outdata_basic[1],
-                "edn": outdata_basic[2],
-                "eup": outdata_basic[3],
-                "uavgdir": outdata_basic[4],
-                "uavgdn": outdata_basic[5],
-                "uavup": outdata_basic[6],
-                "umu": umu,
-                "phi": phi,
-                "u0u(umu)": u0u,
-                "uu(umu,phi)": uu,
-                "error/verbose message": error
-                }
-            output.append(output_dict)
+        # All wavelengths are parsed at once, only complete blocks are kept
+        vals = vals[:int(loop_row_count)*stride]
+        if int(loop_row_count) == 0:
+            outdata_basic, umu, phi, u0u, uu = np.empty((0, 7), dtype=out_dtype), None, None, None, None
+        else:
+            outdata_basic, umu, phi, u0u, uu = parser(vals, umu_length, out_dtype)
+        output = {
+            "lambda": outdata_basic[:, 0], 
+            "edir": outdata_basic[:, 1],
+            "edn": outdata_basic[:, 2],
+            "eup": outdata_basic[:, 3],
+            "uavgdir": outdata_basic[:, 4],
+            "uavgdn": outdata_basic[:, 5],
+            "uavup": outdata_basic[:, 6],
+            "umu": umu,
+            "phi": phi,
+            "u0u(umu)": u0u,
+            "uu(umu,phi)": uu,
+            "error/verbose message": error
+            }
         return output
 
+    return parse_output
+
+
+def compile_runner(conf, out_dtype=np.float32):
+    output_format = int(conf["output_format"])
+    _, _, has_umu_rows = OUTPUT_FORMAT_PARSERS[output_format]
+    umu_length = int(conf["umu_length"]) if has_umu_rows else 0
+    return _compile_output_parser(output_format, umu_length, np.dtype(out_dtype))
+
+
+def parse_uvspec_output(vals, error, returncode, conf, out_dtype=np.float32):
+    return compile_runner(conf, out_dtype)(vals, error, returncode)
+
+
+def results_as_dicts(results):
+    # Error messages are passed through as they are
+    if isinstance(results, str):
+        return results
+    output = list()
+    for ind in range(len(results["lambda"])):
+        output_dict = {key: value if value is None or isinstance(value, str) else value[ind]
+                       for key, value in results.items()}
+        output.append(output_dict)
+    return output
+
+
+def uvspec_bin_path(libradtran_bin_file_loc):
+    # uvspec is started without a shell, so ~ and $VAR in the location are expanded here
+    return os.path.join(os.path.expandvars(os.path.expanduser(libradtran_bin_file_loc)), "uvspec")
+
+
+def run_libradtran(libradtran_bin_file_loc, params, conf, out_dtype=np.float32, output_parser=None):
+    if output_parser is None:
+        output_parser = compile_runner(conf, out_dtype)
+    pros = sp.Popen([uvspec_bin_path(libradtran_bin_file_loc)], stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+    vals, error = pros.communicate(input=str.encode(params))
+    return output_parser(vals, error, pros.returncode)
+
+
+async def run_libradtran_async(libradtran_bin_file_loc, params, conf, out_dtype=np.float32, output_parser=None):
+    if output_parser is None:
+        output_parser = compile_runner(conf, out_dtype)
+    pros = await asyncio.create_subprocess_exec(uvspec_bin_path(libradtran_bin_file_loc), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+    vals, error = await pros.communicate(input=str.encode(params))
+    return output_parser(vals, error, pros.returncode)
+
 
 # In[]:
 # ########################################################################
 # run_conf_files_libradtran Related Functions
 # ########################################################################
 
-def add_to_main_input_str(main_str, temp_file_var_name, temp_file_name):
-    word = "disort"
-    start_index = main_str.find(word)
-    end_index = start_index + len(word)
-    temp_str_to_add = f"\n{temp_file_var_name} {temp_file_name}" 
+# External files are added to the main input right after this word
+TEMP_FILE_ANCHOR = "disort"
+
+
+def add_temp_files_to_main_input_str(main_str, temp_file_names):
+    start_index = main_str.find(TEMP_FILE_ANCHOR)
+    end_index = start_index + len(TEMP_FILE_ANCHOR)
+    # Reversed to keep the order given by repeated add_to_main_input_str calls
+    temp_str_to_add = "".join(f"\n{temp_file_var_name} {temp_file_name}" for temp_file_var_name, temp_file_name in reversed(list(temp_file_names.items())))
     main_str_modified = main_str[:end_index] + temp_str_to_add + main_str[end_index:]
     return main_str_modified
 
 
+def add_to_main_input_str(main_str, temp_file_var_name, temp_file_name):
+    return add_temp_files_to_main_input_str(main_str, {temp_file_var_name: temp_file_name})
+
+
 # In[]:
 # ########################################################################
 # Main Run libRadtran With Configurrations Function
 # ########################################################################
 
-def run_conf_files_libradtran(libradtran_bin_file_loc, conf_file_list, verbose=True):
-    conf_results = list()
-    for conf_file in conf_file_list:
-        #print("Running with UVSPEC file:", conf_file.split("/")[-1])
-        if isinstance(conf_file, str) and conf_file.endswith('.ini'):
-            configuration = ConfigParser()
-            configuration.read(conf_file)
-        else:
-            configuration = conf_file
-        parser_conf = configuration["parser_options"]
-        main_input_str = configuration["main_str"]["input_str"]
-        temp_exist = False
-        for key in configuration:
-            if key == "temp_strs":
-                temp_exist = True
-        if temp_exist:
-            temp_files = configuration["temp_strs"]
-            with tempfile.TemporaryDirectory() as tmpdir:
-                for key in temp_files:
-                    temp = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
-                    temp.write(temp_files[key].encode())
-                    temp.seek(0)
-                    main_input_str = add_to_main_input_str(main_input_str, key, temp.name)
-                results = run_libradtran(libradtran_bin_file_loc, main_input_str, parser_conf)
-        else:
-            results = run_libradtran(libradtran_bin_file_loc, main_input_str, parser_conf)
-        conf_results.append(results)
+def write_temp_file(tmpdir, contents, written_temp_files, temp_file_lock):
+    # Files are named by the hash of their contents, so configurations sharing
+    # the same external file contents also share one written file
+    payload = contents.encode()
+    digest = hashlib.blake2b(payload, digest_size=16).digest()
+    with temp_file_lock:
+        if digest not in written_temp_files:
+            temp_file_name = os.path.join(tmpdir, digest.hex())
+            fd = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.write(fd, payload)
+            finally:
+                os.close(fd)
+            written_temp_files[digest] = temp_file_name
+        return written_temp_files[digest]
+
+
+def read_configuration(configuration):
+    parser_conf = dict(configuration["parser_options"])
+    main_input_str = configuration["main_str"]["input_str"]
+    if "temp_strs" in configuration:
+        temp_files = dict(configuration["temp_strs"])
+    else:
+        temp_files = dict()
+    return main_input_str, parser_conf, temp_files
+
+
+@lru_cache(maxsize=256)
+def _read_ini_file(conf_file, mtime_ns):
+    # mtime_ns is part of the cache key so that edited files are read again
+    configuration = ConfigParser()
+    configuration.read(conf_file)
+    return read_configuration(configuration)
+
+
+def _load_ini_file(conf_file):
+    conf_file = os.path.abspath(conf_file)
+    main_input_str, parser_conf, temp_files = _read_ini_file(conf_file, os.stat(conf_file).st_mtime_ns)
+    # Copies so that callers can not modify the cached configuration
+    return main_input_str, dict(parser_conf), dict(temp_files)
+
+
+def _run_one_conf_file(conf_file, libradtran_bin_file_loc, tmpdir, out_dtype, written_temp_files, temp_file_lock):
+    #print("Running with UVSPEC file:", conf_file.split("/")[-1])
+    if isinstance(conf_file, str) and conf_file.endswith('.ini'):
+        main_input_str, parser_conf, temp_files = _load_ini_file(conf_file)
+    else:
+        main_input_str, parser_conf, temp_files = read_configuration(conf_file)
+    if temp_files:
+        temp_file_names = {key: write_temp_file(tmpdir, temp_files[key], written_temp_files, temp_file_lock) for key in temp_files}
+        main_input_str = add_temp_files_to_main_input_str(main_input_str, temp_file_names)
+    # Parsers are cached by output_format and umu_length, so a batch with fixed
+    # parser options compiles its parser only once
+    output_parser = compile_runner(parser_conf, out_dtype)
+    results = run_libradtran(libradtran_bin_file_loc, main_input_str, parser_conf, output_parser=output_parser)
+    return results
+
+
+def run_conf_files_libradtran(libradtran_bin_file_loc, conf_file_list, verbose=True, max_workers=None, out_dtype=np.float32):
+    # uvspec runs are independent and communicate() waits outside the GIL,
+    # so threads are enough to keep several uvspec processes running
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    # One temporary directory holds the external files of every configuration
+    with tempfile.TemporaryDirectory() as tmpdir:
+        run_one = partial(_run_one_conf_file, libradtran_bin_file_loc=libradtran_bin_file_loc, tmpdir=tmpdir, out_dtype=out_dtype,
+                          written_temp_files=dict(), temp_file_lock=threading.Lock())
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            conf_results = list(executor.map(run_one, conf_file_list))
     return conf_results
 
 
@@ -326,22 +470,10 @@ def run_pmom(libradtran_bin_file_loc, profile_string, moments):
 # ########################################################################
 
 def profile_parser(col1, col2):
-    for ind, (hei, val) in enumerate(zip(col1, col2)):
-        if ind == 0:
-            ar_str = f"{hei} {val}\n"
-        else:
-            val_str = f"{hei} {val}\n"
-            ar_str = f"{ar_str}{val_str}" 
-    return ar_str
+    return "".join(f"{hei} {val}\n" for hei, val in zip(col1, col2))
 
 
 def array_to_string_parser(ar):
     if ar.size == 1:
-        ar_str = str(ar)
-    else:
-        for ind, val in enumerate(ar):
-            if ind == 0:
-                ar_str = str(val)
-            else:
-                ar_str = f"{ar_str} {val}" 
-    return ar_str
+        return str(ar)
+    return " ".join(map(str, ar))